@@ -49,12 +49,15 @@ can be inserted by adding your own tags to the content.
 """
 from __future__ import annotations
 import re
+import functools
+from collections import deque
+from itertools import islice
 from xml.etree.ElementTree import Element, SubElement
 from markdown.extensions import Extension, attr_list
 from markdown.blockprocessors import BlockProcessor
 from markdown.treeprocessors import Treeprocessor
 
-from typing import TYPE_CHECKING, List, Optional, Tuple, Dict
+from typing import TYPE_CHECKING, Deque, List, Optional, Dict, Set, Tuple
 
 if TYPE_CHECKING:
     from markdown import Markdown
@@ -63,6 +66,24 @@ if TYPE_CHECKING:
 TABLE_ATTR_RE = re.compile(r"a?\{:?(.+)\}(?:\s*(.+))?")
 ITEM_ID_RE = re.compile(r"(?:id=)|#([^ |]+)")
 
+CARET_RE = re.compile(r"\|\^\s*$", re.MULTILINE)
+
+def _find_caret_rows(block: str) -> Set[int]:
+    """Returns the indices of all rows in a block ending with a caret"""
+    caret_rows: Set[int] = set()
+    row_index = 0
+    pos = 0
+    for match in CARET_RE.finditer(block):
+        row_index += block.count("\n", pos, match.start())
+        pos = match.start()
+        caret_rows.add(row_index)
+    return caret_rows
+
+@functools.lru_cache(maxsize=128)
+def _parse_attrs(attrs: str) -> Tuple[Tuple[str, str], ...]:
+    """Parse an attribute string, caching the result"""
+    return tuple(attr_list.get_attrs(attrs))
+
 class Compactor(Treeprocessor):
     """
     Performs a post process on trees created by the "table" extension.
@@ -70,39 +91,74 @@ class Compactor(Treeprocessor):
     row.  In addition, line breaks may be optionally inserted based on
     the configuration.
     """
+    NAME_RE = attr_list.AttrListTreeprocessor.NAME_RE
+
     def __init__(self, ins_brk: bool) -> None:
-        self.table_blocks: List[List[str]] = []
-        self.sep = "<br/>" if ins_brk else " "
-        super(Compactor, self).__init__()
+        self.table_blocks: Deque[str] = deque()
+        self._sep_join = ("<br/>" if ins_brk else " ").join
+        super().__init__()
 
     def add_block(self, block: str) -> None:
         """Called by the block processor when a table block is detected"""
-        self.table_blocks.append(block.split("\n"))
+        self.table_blocks.append(block)
 
     def run(self, root: Element) -> Optional[Element]:
-        # Add table attributes first.  This will mutate each table
-        # and apply the attributes before we come back around to
-        # compact it.
-        self.add_table_attributes(root)
-        items_to_move: Dict[str, Tuple[Element, Element, Element]] = {}
-        for tbl_index, table in enumerate(root.iter("table")):
-            rows = self.table_blocks[tbl_index]
-            if len(rows) < 4:
+        if not self.table_blocks:
+            # No tables were detected, skip walking the tree
+            return None
+        try:
+            self._compact(root)
+        finally:
+            # Blocks are consumed per document, make sure nothing is
+            # carried over when the Markdown instance is reused
+            self.table_blocks.clear()
+        return None
+
+    def _compact(self, root: Element) -> None:
+        items_to_move: Dict[str, Element] = {}
+        for table in root.iter("table"):
+            if not self.table_blocks:
+                break
+            block = self.table_blocks.popleft()
+            if block.count("\n") < 3:
                 # The top two rows are the header. If we have a table
                 # with a single row there is nothing to do.
                 continue
-            rows = rows[2:]
             tbody = table.find("tbody")
             if tbody is None:
                 continue
-            assert len(rows) == len(tbody)
-            row_remove: List[Element] = []  # List of tr elements to remove
-            prev_tr: Optional[Element] = None
-            for orig_row, tr in zip(rows, tbody):
-                if prev_tr is None:
+            rows = block.split("\n")
+            # Apply table attributes first, this removes the attribute
+            # row from both the source rows and the tbody element.
+            self.add_table_attributes(table, tbody, rows)
+            if len(rows) < 4:
+                continue
+            if "|^" not in block and "|+" not in block:
+                # No rows to join or embed
+                continue
+            trs = list(tbody)
+            if len(rows) - 2 != len(trs):
+                # The source block does not match this table, joining
+                # would merge the wrong rows
+                continue
+            caret_rows = _find_caret_rows(block)
+            # Pair each body row's source with its tr element up front
+            pairs = list(zip(islice(rows, 2, None), trs))
+            # Marks the tr elements to keep after joining
+            keep_mask: List[bool] = [True] * len(trs)
+            # Snapshot of the text in each td, indexed by [row][column]
+            texts: List[List[Optional[str]]] = [
+                [td.text for td in tr] for tr in trs
+            ]
+            # Text fragments to join, keyed by the (row, column) of the
+            # td they are joined into
+            frags: Dict[Tuple[int, int], List[str]] = {}
+            prev_index: Optional[int] = None
+            for tr_index, (orig_row, tr) in enumerate(pairs):
+                if prev_index is None:
                     # Can't join first row, so skip it and initialize
-                    # the previous tr element
-                    prev_tr = tr
+                    # the previous tr index
+                    prev_index = tr_index
                     continue
                 if orig_row.strip().endswith("|+"):
                     # the first element must contain the id we are looking for
@@ -117,72 +173,82 @@ class Compactor(Treeprocessor):
                     col_count = len(tr)
                     tr.clear()
                     tr.set("compact-container", "")
-                    item_parent = root.find(f".//*[@id='{item_id}']/..")
-                    if item_parent is None:
-                        raise Exception(
-                            f"Unable to find parent of an element matching id {item_id}"
-                        )
-                    item = item_parent.find(f"./*[@id='{item_id}']")
-                    assert item is not None
                     td = SubElement(tr, "td", {"colspan": f"{col_count}"})
-                    items_to_move[item_id] = (item_parent, td, item)
-                elif orig_row.strip().endswith("|^"):
-                    # join current tds with previous tds
-                    for prev_td, cur_td in zip(prev_tr, tr):
-                        if not cur_td.text:
+                    items_to_move[item_id] = td
+                elif tr_index + 2 in caret_rows:
+                    # join current tds with previous tds.  Note that the
+                    # caret row indices include the two header rows.
+                    for col, (prev_text, cur_text) in enumerate(
+                        zip(texts[prev_index], texts[tr_index])
+                    ):
+                        if not cur_text:
                             continue
-                        if not prev_td.text:
-                            prev_td.text = cur_td.text
-                        else:
-                            prev_td.text += self.sep + cur_td.text
-                    row_remove.append(tr)
+                        frags.setdefault(
+                            (prev_index, col), [prev_text or ""]
+                        ).append(cur_text)
+                    keep_mask[tr_index] = False
                 else:
-                    prev_tr = tr
+                    prev_index = tr_index
+
+            # Join the collected text once per td
+            self._merge(trs, frags)
 
             # Remove joined tr elements
-            for tr in row_remove:
-                tbody.remove(tr)
+            if not all(keep_mask):
+                tbody[:] = [tr for tr, keep in zip(trs, keep_mask) if keep]
 
         # Move items into td elements.  This is done after iteration as its
-        # possible to embed one table into another
-        for (parent_el, td, item) in items_to_move.values():
-            parent_el.remove(item)
+        # possible to embed one table into another.  Item lookups are also
+        # deferred, as the id of a table following this one will not be
+        # assigned until it is reached.
+        for item_id, td in items_to_move.items():
+            item_parent = root.find(f".//*[@id='{item_id}']/..")
+            if item_parent is None:
+                raise Exception(
+                    f"Unable to find parent of an element matching id {item_id}"
+                )
+            item = item_parent.find(f"./*[@id='{item_id}']")
+            assert item is not None
+            item_parent.remove(item)
             td.append(item)
 
-        return None
+    def _merge(
+        self, trs: List[Element], frags: Dict[Tuple[int, int], List[str]]
+    ) -> None:
+        """Join text fragments into each td with the configured separator"""
+        sep_join = self._sep_join
+        for (row, col), parts in frags.items():
+            trs[row][col].text = sep_join(f for f in parts if f)
 
-    def add_table_attributes(self, root: Element) -> None:
+    def add_table_attributes(
+        self, table: Element, tbody: Element, rows: List[str]
+    ) -> None:
         """
-        Iterates through all tables and applies attributes specified
-        in the last row.
+        Applies attributes and caption specified in the last row of
+        a table.  The attribute row is removed from `rows` and `tbody`.
         """
-        for tbl_index, table in enumerate(root.iter("table")):
-            rows = self.table_blocks[tbl_index]
-            if len(rows) < 4:
-                # The top two rows are the header. If we have a table
-                # with a single row there is nothing to do.
-                continue
-            tbody = table.find("tbody")
-            if tbody is None:
-                continue
-            attr_match = TABLE_ATTR_RE.match(rows[-1].strip())
-            caption: Optional[str] = None
-            if attr_match is not None:
-                attrs = attr_match.group(1)
-                caption = attr_match.group(2)
-                rows.pop()
-                tbody.remove(tbody[-1])
-                if attrs:
-                    self.assign_attrs(table, attrs)
-                # Insert Caption If Found
-                if caption is not None:
-                    captag = Element("caption")
-                    captag.text = caption.strip().replace("\\|", "|")
-                    table.insert(0, captag)
+        last = rows[-1].lstrip()
+        if not last.startswith(("{", "a{")):
+            # Not an attribute row, avoid running the regex
+            return
+        attr_match = TABLE_ATTR_RE.match(last.rstrip())
+        caption: Optional[str] = None
+        if attr_match is not None:
+            attrs = attr_match.group(1)
+            caption = attr_match.group(2)
+            rows.pop()
+            del tbody[-1]
+            if attrs:
+                self.assign_attrs(table, attrs)
+            # Insert Caption If Found
+            if caption is not None:
+                captag = Element("caption")
+                captag.text = caption.strip().replace("\\|", "|")
+                table.insert(0, captag)
 
     def assign_attrs(self, elem: Element, attrs: str) -> None:
         """ Assign `attrs` to element. Code from attr_list extension."""
-        for k, v in attr_list.get_attrs(attrs):
+        for k, v in _parse_attrs(attrs):
             if k == '.':
                 # add to class
                 cls = elem.get('class')
@@ -201,7 +267,10 @@ class Compactor(Treeprocessor):
 
         Code from attr_list extension.
         """
-        return attr_list.AttrListTreeprocessor.NAME_RE.sub('_', name)
+        if self.NAME_RE.search(name) is None:
+            # Name contains no illegal characters
+            return name
+        return self.NAME_RE.sub('_', name)
 
 class TableBlockRetreiver(BlockProcessor):
     """
@@ -217,11 +286,13 @@ class TableBlockRetreiver(BlockProcessor):
     ) -> None:
         self.compactor = compactor
         self.orig_table_procesor = md_parser.blockprocessors['table']
-        super(TableBlockRetreiver, self).__init__(md_parser)
+        super().__init__(md_parser)
+        # Cache the bound method to avoid a lookup on every block
+        self._test = self.orig_table_procesor.test
 
     def test(self, parent: Element, block: str):
         """Use the table procesor to test if this block is a valid table"""
-        return self.orig_table_procesor.test(parent, block)
+        return self._test(parent, block)
 
     def run(self, parent: Element, blocks: List[str]):
         """Add the block to the compactor"""
@@ -231,20 +302,28 @@ class TableBlockRetreiver(BlockProcessor):
 class CompactTableExtension(Extension):
     """ Allows the Markdown Table source to be compact and readable """
 
-    def __init__(self, **kwargs):
+    def __init__(self, **kwargs) -> None:
         self.config = {
             "auto_insert_break": [False, "True to enable automatic break insertion"],
         }
+        self.compactor: Optional[Compactor] = None
         super().__init__(**kwargs)
     def extendMarkdown(self, md: Markdown) -> None:
         ins_brk = self.getConfig("auto_insert_break", True)
         if 'table' in md.parser.blockprocessors:
             compactor = Compactor(ins_brk)
+            self.compactor = compactor
             md.parser.blockprocessors.register(
                 TableBlockRetreiver(compactor, md.parser),
                 "compact_tables", 80
             )
             md.treeprocessors.register(compactor, "compact_tables", 30)
+            md.registerExtension(self)
+
+    def reset(self) -> None:
+        """Discard table blocks left over from a failed conversion"""
+        if self.compactor is not None:
+            self.compactor.table_blocks.clear()
 
 def makeExtension(*args, **kwargs):
     return CompactTableExtension(*args, **kwargs)